@@ -4,8 +4,10 @@ from pydantic import BaseModel
 class PaperItem(BaseModel):
     arxiv_id: str
     title: str
+    title_html: str
     summary: str
     authors: list[str]
+    authors_html: str
     pdf_url: str
     abs_url: str
 
@@ -1,12 +1,12 @@
-import os, re, html, smtplib, httpx, fitz
+import os, io, re, html, random, smtplib, asyncio, threading, httpx, fitz
 from datetime import datetime, timedelta, timezone
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
+from email.message import EmailMessage
 from dotenv import load_dotenv
+from aiolimiter import AsyncLimiter
 import arxiv
+import diskcache
 from data_model import PaperItem, PaperDigest
-from collections import defaultdict
+from collections.abc import AsyncIterator
 
 load_dotenv()
 
@@ -21,80 +21,172 @@ MAIL_TO = os.getenv("MAIL_TO", SMTP_USER)
 MAIL_TO_LIST = [addr.strip() for addr in MAIL_TO.split(",") if addr.strip()]
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 LANGUAGE = os.getenv("LANGUAGE", "zh")
-
-
-def fetch_recent_arxiv(category: str, lookback_hours: int) -> list[PaperItem]:
-    """'Fetch recent arXiv papers in the given category within the lookback hours."""
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))
+PDF_CONCURRENCY = int(os.getenv("PDF_CONCURRENCY", str(2 * GEMINI_CONCURRENCY)))
+GEMINI_MAX_RETRIES = 8
+GEMINI_MAX_BACKOFF = 60
+ZH_DELIMITER = "===ZH==="
+ATTACH_FIGURES = os.getenv("ATTACH_FIGURES", "0") == "1"
+DIGEST_CACHE_DIR = os.getenv("DIGEST_CACHE_DIR", ".digest_cache")
+DIGEST_CACHE_TTL = 14 * 86400
+
+# affiliation parsing
+_AFF_PREFIX = re.compile(r"^\d+\s*[-–:]?\s*")
+_WS = re.compile(r"\s+")
+_AFF_KEYWORDS = (
+    "university",
+    "institute",
+    "college",
+    "lab",
+    "centre",
+    "center",
+    "academy",
+)
+_AFF_DFA = re.compile("|".join(_AFF_KEYWORDS), re.IGNORECASE)
+
+# Gemini rate limits: requests per minute and in-flight requests.
+_gemini_rpm = AsyncLimiter(GEMINI_RPM, 60)
+_gemini_sem = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# Fire-and-forget uploaded-file deletions, awaited before run() exits.
+_background_tasks: set[asyncio.Task] = set()
+
+# Papers downloaded and held in memory at once, from download until summarized.
+_pdf_sem = asyncio.Semaphore(PDF_CONCURRENCY)
+
+# arxiv_id -> (summary_en, zh_summary, main_img), persisted across runs
+_digest_cache = diskcache.Cache(DIGEST_CACHE_DIR)
+
+# PyMuPDF is not thread-safe; documents are parsed in worker threads one at a time.
+_FITZ_LOCK = threading.Lock()
+
+
+async def fetch_recent_arxiv(
+    category: str, lookback_hours: int
+) -> AsyncIterator[PaperItem]:
+    """Yield recent arXiv papers from the latest day as the result pages arrive.
+
+    Results are sorted by submission date (newest first), so the cutoff, day
+    grouping and early exit all use ``published``, which only decreases along
+    the feed: the first paper's day is the latest day and iteration stops at
+    the first older one.
+    """
     cutoff = datetime.now(timezone.utc) - timedelta(hours=lookback_hours)
     search = arxiv.Search(
         query=f"cat:{category}",
-        max_results=200,
+        max_results=100,
         sort_by=arxiv.SortCriterion.SubmittedDate,
+        sort_order=arxiv.SortOrder.Descending,
     )
     client = arxiv.Client(page_size=100, delay_seconds=2.0)
-    papers_by_day = defaultdict(list)
+    results = client.results(search)
+    latest_day, count = None, 0
 
     try:
-        for result in client.results(search):
-            updated = result.updated or result.published
-            if updated < cutoff:
-                continue
-            day = updated.date()
+        # arxiv.Client blocks (and sleeps between pages); pull it off the event loop.
+        while (result := await asyncio.to_thread(next, results, None)) is not None:
+            published = result.published
+            if published < cutoff:
+                break
+            day = published.date()
+            if latest_day is None:
+                latest_day = day
+            if day < latest_day:
+                break
             authors = [a.name for a in result.authors]
             affs = [
                 a.affiliation for a in result.authors if getattr(a, "affiliation", None)
             ]
-            item = PaperItem(
+            title = result.title.strip()
+            count += 1
+            yield PaperItem(
                 arxiv_id=result.get_short_id(),
-                title=result.title.strip(),
+                title=title,
+                title_html=html.escape(title),
                 summary=result.summary.strip(),
                 authors=authors,
+                authors_html=", ".join(html.escape(a) for a in authors),
                 affiliations=list(dict.fromkeys(affs)),
                 pdf_url=result.pdf_url.replace("http://", "https://"),
                 abs_url=result.entry_id,
             )
-            papers_by_day[day].append(item)
     except arxiv.UnexpectedEmptyPageError:
         print("last page reached or no more results.")
 
-    if not papers_by_day:
-        return []
-
-    latest_day = max(papers_by_day.keys())
-    latest_papers = papers_by_day[latest_day]
+    print(f"latest_day: {latest_day}, total papers: {count}")
 
-    print(f"latest_day: {latest_day}, total papers: {len(latest_papers)}")
-    return latest_papers
 
+def process_pdf(
+    pdf_bytes: bytes, with_figure: bool = True
+) -> tuple[list[str], bytes | None]:
+    """Open the PDF once and extract page-0 affiliations and the main figure.
 
-def extract_main_figure(pdf_bytes: bytes) -> bytes | None:
-    """Extract the main figure from the PDF bytes."""
+    The full text is not extracted: Gemini reads the uploaded PDF directly.
+    """
+    affiliations, main_img = [], None
+    # Gemini reads the PDF itself; affiliations and the figure are optional extras.
     try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        best, best_area = None, 0
-        for page in doc:
-            for img in page.get_images(full=True):
-                xref = img[0]
-                pix = fitz.Pixmap(doc, xref)
-                if pix.alpha or pix.n > 4:
-                    pix = fitz.Pixmap(fitz.csRGB, pix)
-                w, h = pix.width, pix.height
-                area = w * h
-                if min(w, h) < 200:
-                    continue
-                if w / h > 6 or h / w > 6:
-                    continue
-                if area > best_area:
-                    best_area, best = area, pix
-        if best:
-            return best.tobytes("png")
+        with _FITZ_LOCK, fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            best_xref, best_area, seen = None, 0, set()
+            for i, page in enumerate(doc):
+                if i == 0:
+                    affiliations = extract_affiliations_from_text(page.get_text("text"))
+                if not with_figure:
+                    break
+
+                # Filter on image metadata; only the winning xref is decoded below.
+                for img in page.get_images(full=True):
+                    xref, w, h = img[0], img[2], img[3]
+                    if xref in seen:
+                        continue
+                    seen.add(xref)
+                    if min(w, h) < 200:
+                        continue
+                    if w / h > 6 or h / w > 6:
+                        continue
+                    area = w * h
+                    if area > best_area:
+                        best_area, best_xref = area, xref
+
+            if best_xref is not None:
+                try:
+                    pix = fitz.Pixmap(doc, best_xref)
+                    if pix.alpha or pix.n > 4:
+                        pix = fitz.Pixmap(fitz.csRGB, pix)
+                    main_img = pix.tobytes("png")
+                except Exception:
+                    pass
     except Exception:
-        pass
-    return None
+        return [], None
+
+    # Pillow is thread-safe, so re-encode outside the lock, in parallel across papers.
+    if main_img:
+        try:
+            main_img = optimize_png(main_img)
+        except Exception:
+            pass
+    return affiliations, main_img
+
+
+def optimize_png(png: bytes) -> bytes:
+    """Re-encode a PNG as an 8-bit palette image to shrink the email attachment."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return png
+
+    buf = io.BytesIO()
+    with Image.open(io.BytesIO(png)) as im:
+        im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        im = im.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        im.save(buf, "PNG", optimize=True)
+    out = buf.getvalue()
+    return out if len(out) < len(png) else png
 
 
 def build_email(digests):
-    msg = MIMEMultipart("related")
+    msg = EmailMessage()
     msg["Subject"] = (
         f"[arXiv {CATEGORY}] 每日摘要（{datetime.now().strftime('%Y-%m-%d')}）"
     )
@@ -105,17 +197,17 @@ def build_email(digests):
     for i, d in enumerate(digests, 1):
         p = d.paper
         block = f"""
-        <h3>{i}. {html.escape(p.title)}</h3>
-        <p><b>作者：</b>{html.escape(', '.join(p.authors))}<br/>
+        <h3>{i}. {p.title_html}</h3>
+        <p><b>作者：</b>{p.authors_html}<br/>
         <a href="{p.abs_url}">摘要页</a> | <a href="{p.pdf_url}">PDF</a></p>
         <p style="white-space: pre-line;">{html.escape(d.zh_summary)}</p>
         """
 
-        # if d.main_img_bytes and d.main_img_cid:
-        #     block += (
-        #         f'<p><img src="cid:{d.main_img_cid}" style="max-width:720px;"/></p>'
-        #     )
-        #     img_attachments.append((d.main_img_cid, d.main_img_bytes))
+        if ATTACH_FIGURES and d.main_img_bytes and d.main_img_cid:
+            block += (
+                f'<p><img src="cid:{d.main_img_cid}" style="max-width:720px;"/></p>'
+            )
+            img_attachments.append((d.main_img_cid, d.main_img_bytes))
 
         html_blocks.append(block)
 
@@ -126,21 +218,18 @@ def build_email(digests):
     <hr/><p style="color:#888">Gemini 自动生成 · 请核对原文。</p></body></html>
     """
 
-    alt = MIMEMultipart("alternative")
-    alt.attach(MIMEText("请使用 HTML 邮件查看。", "plain", "utf-8"))
-    alt.attach(MIMEText(html_body, "html", "utf-8"))
-    msg.attach(alt)
+    msg.set_content("请使用 HTML 邮件查看。")
+    msg.add_alternative(html_body, subtype="html")
 
+    html_part = msg.get_payload()[1]
     for cid, b in img_attachments:
-        img = MIMEImage(b, "png")
-        img.add_header("Content-ID", f"<{cid}>")
-        msg.attach(img)
+        html_part.add_related(b, "image", "png", cid=f"<{cid}>")
 
     return msg
 
 
 def build_email_en(digests):
-    msg = MIMEMultipart("related")
+    msg = EmailMessage()
     msg["Subject"] = (
         f"[arXiv {CATEGORY}] Daily Digest ({datetime.now().strftime('%Y-%m-%d')})"
     )
@@ -151,17 +240,17 @@ def build_email_en(digests):
     for i, d in enumerate(digests, 1):
         p = d.paper
         block = f"""
-        <h3>{i}. {html.escape(p.title)}</h3>
-        <p><b>Authors:</b> {html.escape(', '.join(p.authors))}<br/>
+        <h3>{i}. {p.title_html}</h3>
+        <p><b>Authors:</b> {p.authors_html}<br/>
         <a href="{p.abs_url}">Abstract Page</a> | <a href="{p.pdf_url}">PDF</a></p>
         <p style="white-space: pre-line;">{html.escape(d.summary_en)}</p>
         """
 
-        # If d.main_img_bytes and d.main_img_cid:
-        #     block += (
-        #         f'<p><img src="cid:{d.main_img_cid}" style="max-width:720px;"/></p>'
-        #     )
-        #     img_attachments.append((d.main_img_cid, d.main_img_bytes))
+        if ATTACH_FIGURES and d.main_img_bytes and d.main_img_cid:
+            block += (
+                f'<p><img src="cid:{d.main_img_cid}" style="max-width:720px;"/></p>'
+            )
+            img_attachments.append((d.main_img_cid, d.main_img_bytes))
 
         html_blocks.append(block)
 
@@ -172,149 +261,209 @@ def build_email_en(digests):
     <hr/><p style="color:#888">Automatically generated by Gemini · Please verify with the original text.</p></body></html>
     """
 
-    alt = MIMEMultipart("alternative")
-    alt.attach(MIMEText("Please view this email in HTML format.", "plain", "utf-8"))
-    alt.attach(MIMEText(html_body, "html", "utf-8"))
-    msg.attach(alt)
+    msg.set_content("Please view this email in HTML format.")
+    msg.add_alternative(html_body, subtype="html")
 
+    html_part = msg.get_payload()[1]
     for cid, b in img_attachments:
-        img = MIMEImage(b, "png")
-        img.add_header("Content-ID", f"<{cid}>")
-        msg.attach(img)
+        html_part.add_related(b, "image", "png", cid=f"<{cid}>")
 
     return msg
 
 
-def send_email(msg):
+def send_email(*msgs):
+    """Send one or more messages over a single STARTTLS/login session."""
     with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as s:
         s.starttls()
         s.login(SMTP_USER, SMTP_PASS)
-        s.sendmail(SMTP_USER, MAIL_TO_LIST, msg.as_string())
+        for msg in msgs:
+            s.send_message(msg, from_addr=SMTP_USER, to_addrs=MAIL_TO_LIST)
 
 
-def extract_affiliations_from_pdf(pdf_bytes: bytes) -> list[str]:
-    affiliations = set()
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        text = doc[0].get_text("text")
-        lines = [l.strip() for l in text.split("\n") if l.strip()]
-
-        for line in lines:
-            if re.match(r"^\d+\s*[-–:]?\s*", line):
-                if any(
-                    k in line.lower()
-                    for k in [
-                        "university",
-                        "institute",
-                        "college",
-                        "lab",
-                        "centre",
-                        "center",
-                    ]
-                ):
-                    affiliations.add(line)
-
-        if not affiliations:
-            for line in lines:
-                if any(
-                    k in line.lower()
-                    for k in ["university", "institute", "college", "academy", "lab"]
-                ):
-                    affiliations.add(line)
-
-        cleaned = []
-        for aff in affiliations:
-            aff = re.sub(r"^\d+\s*[-–:]?\s*", "", aff).strip()
-            aff = re.sub(r"\s+", " ", aff)
-            cleaned.append(aff)
-
-        return list(dict.fromkeys(cleaned))
+def extract_affiliations_from_text(page0_text: str) -> list[str]:
+    """Extract affiliation lines from the already-extracted first-page text.
+
+    Numbered lines (e.g. "1 University of ...") are preferred; any other line
+    mentioning an affiliation keyword is only used when none are numbered.
+    """
+    numbered, other = {}, {}
+    # Scan the whole page in C and only touch the lines that contain a keyword.
+    pos = 0
+    while m := _AFF_DFA.search(page0_text, pos):
+        start = page0_text.rfind("\n", 0, m.start()) + 1
+        end = page0_text.find("\n", m.end())
+        if end < 0:
+            end = len(page0_text)
+        pos = end + 1
+        line = page0_text[start:end].strip()
+        bucket = numbered if _AFF_PREFIX.match(line) else other
+        norm = _WS.sub(" ", _AFF_PREFIX.sub("", line)).strip()
+        if norm:
+            bucket.setdefault(norm, None)
+    return list(numbered or other)
+
+
+def _retry_delay(e) -> float | None:
+    """Return the server-suggested retry delay (RetryInfo) from a 429, if any."""
+    for detail in getattr(e, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
 
-    except Exception:
-        return []
 
+def _backoff_delay(attempt: int, suggested: float | None = None) -> float:
+    """Server-suggested delay if given, else capped exponential; plus jitter."""
+    if suggested is None:
+        suggested = min(2**attempt, GEMINI_MAX_BACKOFF)
+    return suggested + random.uniform(0, 1)
 
-def summarize_from_pdf(paper):
-    import os, httpx, tempfile, google.generativeai as genai, fitz
+
+async def generate_with_backoff(model, contents):
+    """Call Gemini under the rate limiter, retrying 429s with jittered backoff."""
+    from google.api_core.exceptions import ResourceExhausted
+
+    for attempt in range(GEMINI_MAX_RETRIES):
+        try:
+            async with _gemini_rpm, _gemini_sem:
+                return await model.generate_content_async(contents)
+        except ResourceExhausted as e:
+            if attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(_backoff_delay(attempt, _retry_delay(e)))
+
+
+async def upload_pdf_with_backoff(genai, pdf_bytes: bytes, display_name: str):
+    """Upload a PDF to the Gemini Files API, retrying 429/5xx with jittered backoff.
+
+    The Files API has its own quota, so uploads bypass the generate rate limiter.
+    """
+    from googleapiclient.errors import HttpError
+
+    for attempt in range(GEMINI_MAX_RETRIES):
+        try:
+            return await asyncio.to_thread(
+                genai.upload_file,
+                io.BytesIO(pdf_bytes),
+                mime_type="application/pdf",
+                display_name=display_name,
+            )
+        except HttpError as e:
+            if e.resp.status != 429 and e.resp.status < 500:
+                raise
+            if attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(_backoff_delay(attempt))
+
+
+def delete_uploaded_file(genai, name: str) -> None:
+    """Delete an uploaded file in the background; uploads also expire on their own."""
+
+    def done(task: asyncio.Task) -> None:
+        _background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"failed to delete uploaded file {name}: {task.exception()!r}")
+
+    task = asyncio.create_task(asyncio.to_thread(genai.delete_file, name))
+    _background_tasks.add(task)
+    task.add_done_callback(done)
+
+
+async def summarize_from_pdf(paper, pdf_bytes: bytes, affiliations: list[str]):
+    import google.generativeai as genai
 
     genai.configure(api_key=GOOGLE_API_KEY)
     model = genai.GenerativeModel("gemini-2.5-flash")
 
-    pdf_path = None
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            pdf_path = tmp.name
-            with httpx.Client(timeout=30) as client:
-                r = client.get(paper.pdf_url)
-                r.raise_for_status()
-                tmp.write(r.content)
-
-        with open(pdf_path, "rb") as f:
-            pdf_bytes = f.read()
-        affiliations = extract_affiliations_from_pdf(pdf_bytes)
-
-        text = []
-        with fitz.open(pdf_path) as doc:
-            for page in doc:
-                text.append(page.get_text("text"))
-        full_text = "\n".join(text)
-
-        aff_text = ", ".join(affiliations) if affiliations else "the research team"
-        prompt = f"""
+    # Gemini parses the PDF itself, so no local text extraction is needed.
+    pdf_file = await upload_pdf_with_backoff(
+        genai, pdf_bytes, f"{paper.arxiv_id}.pdf"
+    )
+
+    aff_text = ", ".join(affiliations) if affiliations else "the research team"
+    prompt = f"""
 You are an expert academic summarizer.
-Based on the following paper content, write a concise summary (1-2 paragraphs) in English.
+Based on the attached paper PDF, write a concise summary (1-2 paragraphs) in English.
 The summary should start with: "{aff_text} ..." describing what they did, and naturally include the motivation, method, and results.
 Write in formal academic English.
+Then translate that summary into fluent, formal academic Chinese, keeping technical terms and the same opening.
+Output exactly two sections separated by the literal line "{ZH_DELIMITER}": first the English summary, then the Chinese translation.
 
 Title: {paper.title}
 Authors: {', '.join(paper.authors)}
 Affiliations: {aff_text}
-Paper Content:
-{full_text[:20000]}
 """
-        response = model.generate_content(prompt)
-        summary_en = response.text.strip()
+    try:
+        response = await generate_with_backoff(model, [prompt, pdf_file])
+    finally:
+        delete_uploaded_file(genai, pdf_file.name)
+    summary_en, found, zh_summary = response.text.partition(ZH_DELIMITER)
+    summary_en, zh_summary = summary_en.strip(), zh_summary.strip()
+    complete = bool(found and zh_summary)
 
-        zh_prompt = (
-            "将以下英文研究总结翻译成流畅、正式的学术中文，并保留专业术语。保持开头格式不变：\n\n"
-            f"{summary_en}"
-        )
-        zh_response = model.generate_content(zh_prompt)
-        zh_summary = zh_response.text.strip()
+    # The third item says whether both languages came back (safe to cache).
+    return summary_en, zh_summary or summary_en, complete
 
-        return summary_en, zh_summary
 
-    finally:
-        if pdf_path and os.path.exists(pdf_path):
-            os.remove(pdf_path)
+async def process_paper(client: httpx.AsyncClient, p) -> PaperDigest:
+    print(f"processing paper: {p.arxiv_id}")
+    key = (p.arxiv_id, ATTACH_FIGURES)
+    cached = _digest_cache.get(key)
+    if cached is not None:
+        summary_en, zh_summary, img = cached
+    else:
+        async with _pdf_sem:
+            r = await client.get(p.pdf_url)
+            r.raise_for_status()
+            affiliations, img = await asyncio.to_thread(
+                process_pdf, r.content, ATTACH_FIGURES
+            )
+            summary_en, zh_summary, complete = await summarize_from_pdf(
+                p, r.content, affiliations
+            )
+        # Don't pin the English fallback as the Chinese summary for the whole TTL.
+        if complete:
+            _digest_cache.set(
+                key, (summary_en, zh_summary, img), expire=DIGEST_CACHE_TTL
+            )
+
+    cid = f"img-{p.arxiv_id}"
+    return PaperDigest(
+        paper=p,
+        zh_summary=zh_summary,
+        summary_en=summary_en,
+        main_img_bytes=img,
+        main_img_cid=cid if img else None,
+    )
 
 
-def run():
-    papers = fetch_recent_arxiv(CATEGORY, LOOKBACK_HOURS)
-    digests = []
-    for p in papers:
-        print(f"total papers fetched: {len(papers)}, processing paper: {p.arxiv_id}")
-        summary_en, zh_summary = summarize_from_pdf(p)
-        img = None
+async def run():
+    # In-flight PDFs are capped by _pdf_sem, Gemini calls by _gemini_sem.
+    limits = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+    timeout = httpx.Timeout(30, pool=None)
+
+    async with httpx.AsyncClient(http2=True, timeout=timeout, limits=limits) as client:
+
+        async def worker(p):
+            try:
+                return await process_paper(client, p)
+            except Exception as e:
+                print(f"failed to process paper {p.arxiv_id}: {e!r}")
+                return None
+
+        # Start summarizing each paper as soon as the arXiv feed yields it.
+        tasks = []
         try:
-            with httpx.Client(timeout=20) as client:
-                r = client.get(p.pdf_url)
-                r.raise_for_status()
-                img = extract_main_figure(r.content)
-        except Exception:
-            pass
+            async for p in fetch_recent_arxiv(CATEGORY, LOOKBACK_HOURS):
+                tasks.append(asyncio.create_task(worker(p)))
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        digests = [d for d in await asyncio.gather(*tasks) if d is not None]
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
 
-        cid = f"img-{p.arxiv_id}"
-        digests.append(
-            PaperDigest(
-                paper=p,
-                zh_summary=zh_summary,
-                summary_en=summary_en,
-                main_img_bytes=img,
-                main_img_cid=cid if img else None,
-            )
-        )
-        break
     if LANGUAGE == "en":
         msg = build_email_en(digests)
     else:
@@ -333,4 +482,4 @@ def run():
 
 
 if __name__ == "__main__":
-    run()
+    asyncio.run(run())